@@ -1,12 +1,14 @@
 import os
 import time
+import logging
 import configparser
+import dask
 import pandas as pd
-from glanvup.rizard import FloodProcess
-from glanvup.cozard import CoastProcess
+from dask.distributed import Client, LocalCluster, wait
 from glanvup.intersections import IntersectLayers
 from glanvup.continents import south_coast
 pd.options.mode.chained_assignment = None
+logger = logging.getLogger(__name__)
 
 CONFIG = configparser.ConfigParser()
 CONFIG.read(os.path.join(os.path.dirname(__file__), 'script_config.ini'))
@@ -18,48 +20,103 @@ DATA_RESULTS = os.path.join(BASE_PATH, 'results')
 
 path = os.path.join(DATA_RAW, 'countries.csv')
 flood_folder = os.path.join(DATA_RAW, 'flood_hazard')
+flood_cog_folder = os.path.join(DATA_PROCESSED, 'flood_hazard_cog')
 coastal_folder = os.path.join(DATA_RAW, 'coastal_hazard')
 
-flood_files = os.listdir(flood_folder)
-coast_files = os.listdir(coastal_folder)
 
-countries = pd.read_csv(path, encoding = 'utf-8-sig')
-income_group = ['LIC', 'LMC', 'UMC']
+def run_coverage(iso3):
+    """
+    Intersect the population and coverage layers 
+    for one country.
 
-for idx, country in countries.iterrows():
+    Parameters
+    ----------
+    iso3 : string
+        Country iso3 to be processed.
+    """
+    intersection = IntersectLayers(iso3, '4G', None)
+    intersection.pop_coverage()
 
-    if not country['income_group'] in income_group or country['gid_region'] == 0 or country['Exclude'] == 1:
-    #if not country['iso3'] == 'RWA':
+    return None
+
+
+#worker processes re-import this script, so only drive the runs from the main one
+if __name__ == '__main__':
+
+    #stage timings (stage=... dur_ns=...) are written to the run log
+    logging.basicConfig(filename = os.path.join(BASE_PATH, 'run_all.log'), 
+                        level = logging.INFO, 
+                        format = '%(asctime)s,%(levelname)s,%(name)s,%(message)s')
+
+    flood_files = os.listdir(flood_folder)
+    coast_files = os.listdir(coastal_folder)
+
+    countries = pd.read_csv(path, encoding = 'utf-8-sig')
+    income_group = ['LIC', 'LMC', 'UMC']
+    iso3s = []
+    tasks = []
+
+    for idx, country in countries.iterrows():
+
+        if not country['income_group'] in income_group or country['gid_region'] == 0 or country['Exclude'] == 1:
+        #if not country['iso3'] == 'RWA':
   
-        continue 
+            continue 
     
-    '''for file in flood_files:
+        '''from glanvup.rizard import FloodProcess, convert_to_cog
 
-        if not file.startswith('.DS_Store'):
+        for file in flood_files:
 
-            flood_tiff = os.path.join(DATA_RAW, 'flood_hazard', file)
+            if not file.startswith('.DS_Store'):
 
-            flooding = FloodProcess(path, countries['iso3'].loc[idx], flood_tiff)
-            flooding.process_flood_tiff()
-            flooding.process_flood_shapefile()
+                #one-time conversion into a tiled COG, skipped once it exists
+                flood_tiff = os.path.join(flood_cog_folder, file)
+                convert_to_cog(os.path.join(flood_folder, file), flood_tiff)
+
+                flooding = FloodProcess(path, countries['iso3'].loc[idx], flood_tiff)
+                flooding.process_flood_tiff(polygonise_regions = True)
             
-            intersection = IntersectLayers(countries['iso3'].loc[idx], '4G', file)
-            intersection.pop_flood()
-            intersection.vulri_intersect_all()
-            intersection.coverage_rizard()'''
+                intersection = IntersectLayers(countries['iso3'].loc[idx], '4G', file)
+                intersection.pop_flood()
+                intersection.vulri_intersect_all()
+                intersection.coverage_rizard()'''
+
+        #the coastal steps are disabled, so they are not scheduled as tasks
+        '''from glanvup.cozard import CoastProcess
 
-    for file in coast_files:
+        for file in coast_files:
         
-        if not file.startswith('.DS_Store'):
+            if not file.startswith('.DS_Store'):
+
+                coastal_tiff = os.path.join(DATA_RAW, 'coastal_hazard', file)
+
+                coastal = CoastProcess(path, countries['iso3'].loc[idx], coastal_tiff)
+                coastal.process_flood_tiff() 
+                coastal.process_flood_shapefile()
+
+                intersection = IntersectLayers(countries['iso3'].loc[idx], '4G', file)
+                intersection.pop_cozard()
+                intersection.vulco_intersect_all()
+                intersection.coverage_cozard()'''
+
+        #population coverage is the only enabled step, one task per country
+        iso3s.append(countries['iso3'].loc[idx])
+        tasks.append(dask.delayed(run_coverage)(countries['iso3'].loc[idx]))
+
+    #bound the memory of each worker so a large region only restarts its own task
+    n_workers = max(1, min(len(tasks), int(0.7 * os.cpu_count())))
+
+    with LocalCluster(n_workers = n_workers, threads_per_worker = 1, 
+                      memory_limit = '4GB') as cluster, Client(cluster) as client:
+
+        #retry tasks whose worker was killed, then log the ones that still failed 
+        #instead of letting a single country abort the whole run
+        futures = client.compute(tasks, retries = 2)
+        wait(futures)
+
+        for iso3, future in zip(iso3s, futures):
 
-            coastal_tiff = os.path.join(DATA_RAW, 'coastal_hazard', file)
+            if future.status == 'error':
 
-            coastal = CoastProcess(path, countries['iso3'].loc[idx], coastal_tiff)
-            #coastal.process_flood_tiff() 
-            #coastal.process_flood_shapefile()
+                logger.error('stage=coverage iso3=%s failed: %r', iso3, future.exception())
 
-            intersection = IntersectLayers(countries['iso3'].loc[idx], '4G', file)
-            #intersection.pop_cozard()
-            #intersection.vulco_intersect_all()
-            #intersection.coverage_cozard()
-            intersection.pop_coverage()
\ No newline at end of file
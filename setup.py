@@ -49,6 +49,7 @@ setup(
     ],
     install_requires=[
         'numpy>=1.16.4',
+        'dask[distributed]',
     ],
     entry_points={
         'console_scripts': [
@@ -7,6 +7,7 @@ import pandas as pd
 from rasterio.mask import mask
 from shapely.geometry import MultiPolygon
 from tqdm import tqdm
+from glanvup.rizard import polygonise
 warnings.filterwarnings('ignore')
 
 class CoastProcess:
@@ -145,40 +146,8 @@ class CoastProcess:
 
                     with rasterio.open(path_in) as src:
 
-                        affine = src.transform
-                        array = src.read(1)
+                        output = polygonise(src.read(1), src.transform, 'epsg:4326')
 
-                        output = []
-
-                        for vec in rasterio.features.shapes(array):
-
-                            if vec[1] > 0 and not vec[1] == 255:
-
-                                coordinates = [i for i in vec[0]['coordinates'][0]]
-
-                                coords = []
-
-                                for i in coordinates:
-
-                                    x = i[0]
-                                    y = i[1]
-
-                                    x2, y2 = src.transform * (x, y)
-
-                                    coords.append((x2, y2))
-
-                                output.append({
-                                    'type': vec[0]['type'],
-                                    'geometry': {
-                                        'type': 'Polygon',
-                                        'coordinates': [coords],
-                                    },
-                                    'properties': {
-                                        'value': vec[1],
-                                    }
-                                })
-
-                    output = gpd.GeoDataFrame.from_features(output, crs = 'epsg:4326')
                     output.to_file(path_out, driver = 'ESRI Shapefile')
             except:
                 pass
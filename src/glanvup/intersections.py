@@ -1,10 +1,16 @@
+import logging
 import os
+import time
 import warnings
 import configparser
 import geopandas as gpd
 import pandas as pd
+import shapely
+from pyogrio.errors import DataSourceError
+from shapely.errors import GEOSException
 pd.options.mode.chained_assignment = None
 warnings.filterwarnings('ignore')
+logger = logging.getLogger(__name__)
 
 CONFIG = configparser.ConfigParser()
 CONFIG.read(os.path.join(os.path.dirname(__file__), 'script_config.ini'))
@@ -15,6 +21,129 @@ DATA_PROCESSED = os.path.join(BASE_PATH, '..', 'results', 'processed')
 DATA_RESULTS = os.path.join(BASE_PATH, '..', 'results', 'final')
 
 
+def read_layer(path, columns = None):
+    """
+    Read a vector layer written either as a 
+    shapefile or as GeoParquet.
+
+    Parameters
+    ----------
+    path : string
+        Path of the vector layer.
+    columns : list
+        Attribute columns to read. All columns 
+        are read if not given.
+
+    Returns
+    -------
+    gdf : geodataframe
+        Layer features.
+
+    """
+    if path.endswith('.parquet'):
+
+        if columns is not None:
+
+            columns = list(columns) + ['geometry']
+
+        gdf = gpd.read_parquet(path, columns = columns)
+
+    else:
+
+        gdf = gpd.read_file(path, engine = 'pyogrio', use_arrow = True, 
+                            columns = columns)
+
+    return gdf
+
+
+def list_layers(folder):
+    """
+    Map each region in a folder to a single vector 
+    layer, preferring GeoParquet over a shapefile 
+    left behind by an earlier run.
+
+    Parameters
+    ----------
+    folder : string
+        Folder containing the region layers.
+
+    Returns
+    -------
+    layers : dict
+        Layer file name keyed by region name.
+
+    """
+    layers = {}
+
+    for filename in sorted(os.listdir(folder)):
+
+        region, extension = os.path.splitext(filename)
+
+        if extension == '.parquet' or (extension == '.shp' and region not in layers):
+
+            layers[region] = filename
+
+    return layers
+
+
+def intersect_gdfs(first_gdf, second_gdf):
+    """
+    Intersect two polygon layers, keeping the 
+    attributes of both as gpd.overlay does.
+
+    Parameters
+    ----------
+    first_gdf : geodataframe
+        First polygon layer.
+    second_gdf : geodataframe
+        Second polygon layer.
+
+    Returns
+    -------
+    intersection : geodataframe
+        Intersected polygons.
+
+    """
+    #bring the second layer into the first layer's CRS, gpd.overlay only warns on a mismatch
+    if first_gdf.crs is not None and second_gdf.crs is not None and first_gdf.crs != second_gdf.crs:
+
+        second_gdf = second_gdf.to_crs(first_gdf.crs)
+
+    #query the STRtree of the second layer for the candidate pairs
+    idx_1, idx_2 = second_gdf.sindex.query(first_gdf.geometry.values, 
+                                           predicate = 'intersects')
+
+    geometry = first_gdf.geometry.values[idx_1].intersection(
+        second_gdf.geometry.values[idx_2])
+
+    first_attrs = first_gdf.drop(columns = first_gdf.geometry.name)
+    first_attrs = first_attrs.iloc[idx_1].reset_index(drop = True)
+    second_attrs = second_gdf.drop(columns = second_gdf.geometry.name)
+    second_attrs = second_attrs.iloc[idx_2].reset_index(drop = True)
+
+    #suffix shared column names as gpd.overlay does
+    duplicates = first_attrs.columns.intersection(second_attrs.columns)
+    first_attrs = first_attrs.rename(columns = {col: '{}_1'.format(col) for col in duplicates})
+    second_attrs = second_attrs.rename(columns = {col: '{}_2'.format(col) for col in duplicates})
+
+    intersection = gpd.GeoDataFrame(pd.concat([first_attrs, second_attrs], axis = 1), 
+                                    geometry = geometry, crs = first_gdf.crs)
+
+    #keep only the polygon parts of mixed intersections, as gpd.overlay does
+    collections = (intersection.geom_type == 'GeometryCollection').to_numpy()
+
+    if collections.any():
+
+        parts = intersection.geometry[collections].explode(index_parts = False)
+        parts = parts[parts.geom_type.isin(['Polygon', 'MultiPolygon'])]
+        polygons = parts.groupby(level = 0).agg(shapely.union_all)
+        intersection.loc[polygons.index, 'geometry'] = polygons.values
+
+    intersection = intersection[intersection.geom_type.isin(['Polygon', 'MultiPolygon'])]
+
+    return intersection.reset_index(drop = True)
+
+
 class IntersectLayers:
 
     """
@@ -185,39 +314,44 @@ class IntersectLayers:
     def intersect_layers(self, folder_1, folder_2, folder_out):
         
         print('Intersecting {} population with hazard layers.'.format(self.country_iso3))
-        for firstfile in os.listdir(folder_1):
-            
-            try:
 
-                if firstfile.endswith('.shp'):
+        #index the hazard layers by region once instead of per population file
+        second_files = list_layers(folder_2)
 
-                    first_shapefile = os.path.join(folder_1, firstfile)
-                    first_gdf = gpd.read_file(first_shapefile)
+        if not os.path.exists(folder_out):
 
-                    for secondfile in os.listdir(folder_2):
+            os.makedirs(folder_out)
 
-                        if secondfile.endswith('.shp'):
+        for firstfile in os.listdir(folder_1):
 
-                            second_shapefile = os.path.join(folder_2, secondfile)
-                            second_gdf = gpd.read_file(second_shapefile)
+            region = os.path.splitext(firstfile)[0]
 
-                            if firstfile in secondfile:
+            #skip regions without a hazard layer before reading anything
+            if not firstfile.endswith('.shp') or region not in second_files:
 
-                                intersection = gpd.overlay(first_gdf, second_gdf, 
-                                                           how = 'intersection')
-                                
-                                region_part = str(firstfile)
-                                
-                                if not os.path.exists(folder_out):
+                continue
+            
+            try:
 
-                                    os.makedirs(folder_out)
+                first_shapefile = os.path.join(folder_1, firstfile)
+                first_gdf = read_layer(first_shapefile)
 
-                                path_out = os.path.join(folder_out, region_part)
+                second_shapefile = os.path.join(folder_2, second_files[region])
+                second_gdf = read_layer(second_shapefile, columns = ['value'])
 
-                                intersection.to_file(path_out, driver = 'ESRI Shapefile')
-            except:
+                start = time.perf_counter_ns()
+                intersection = intersect_gdfs(first_gdf, second_gdf)
+                logger.info('stage=overlay iso3=%s gid=%s dur_ns=%d', self.country_iso3, 
+                            firstfile, time.perf_counter_ns() - start)
+                
+                region_part = str(firstfile)
+                path_out = os.path.join(folder_out, region_part)
 
-                pass
+                intersection.to_file(path_out, driver = 'ESRI Shapefile')
+
+            except (DataSourceError, GEOSException, ValueError) as e:
+
+                logger.warning('Unable to intersect %s layers: %s', firstfile, e)
 
 
         return None
@@ -312,39 +446,38 @@ class IntersectLayers:
         hazard_folder = os.path.join(DATA_PROCESSED, self.country_iso3, 'hazards', 'inunriver', 'shapefiles')
         print('Intersecting population and river hazard layers for {}'.format(self.country_iso3))
 
+        hazard_files = list_layers(hazard_folder)
+
         for firstfile in os.listdir(intersection_2_folder):
             
             try:
 
-                if firstfile.endswith('.shp'):
+                region = os.path.splitext(firstfile)[0]
+
+                if firstfile.endswith('.shp') and region in hazard_files:
 
                     first_shapefile = os.path.join(intersection_2_folder, firstfile)
                     first_gdf = gpd.read_file(first_shapefile)
 
-                    for secondfile in os.listdir(hazard_folder):
-
-                        if secondfile.endswith('.shp'):
+                    second_shapefile = os.path.join(hazard_folder, hazard_files[region])
+                    second_gdf = read_layer(second_shapefile, columns = ['value'])
 
-                            second_shapefile = os.path.join(hazard_folder, secondfile)
-                            second_gdf = gpd.read_file(second_shapefile)
-
-                            if firstfile in secondfile:
-
-                                intersection = gpd.overlay(first_gdf, second_gdf, how = 'intersection')
-                                
-                                region_part = str(firstfile)
-                                flood_part = str(self.flood_file).strip('.tif')
-                                
-                                filename = '{}_{}'.format(flood_part, region_part)
+                    #hazard layers are in the raster's CRS, which intersect_gdfs reconciles
+                    intersection = intersect_gdfs(first_gdf, second_gdf)
+                    
+                    region_part = str(firstfile)
+                    flood_part = str(self.flood_file).strip('.tif')
+                    
+                    filename = '{}_{}'.format(flood_part, region_part)
 
-                                folder_out_3 = os.path.join(DATA_RESULTS, self.country_iso3, 'vul_river_hazard')
-                                if not os.path.exists(folder_out_3):
+                    folder_out_3 = os.path.join(DATA_RESULTS, self.country_iso3, 'vul_river_hazard')
+                    if not os.path.exists(folder_out_3):
 
-                                    os.makedirs(folder_out_3)
-                                    
-                                path_out = os.path.join(folder_out_3, filename)
+                        os.makedirs(folder_out_3)
+                        
+                    path_out = os.path.join(folder_out_3, filename)
 
-                                intersection.to_file(path_out, driver = 'ESRI Shapefile')
+                    intersection.to_file(path_out, driver = 'ESRI Shapefile')
 
             except:
 
@@ -9,6 +9,7 @@ from scipy.spatial import Voronoi
 from shapely.geometry import Polygon
 from shapely.geometry import MultiPolygon
 from tqdm import tqdm
+from glanvup.rizard import polygonise
 
 CONFIG = configparser.ConfigParser()
 CONFIG.read(os.path.join(os.path.dirname(__file__), 'script_config.ini'))
@@ -172,6 +173,9 @@ class ProcessCountry:
         load_glob_info = pd.read_csv(glob_info_path, encoding = 'utf-8-sig', 
                                      keep_default_na = False)
         
+        #narrow the metadata to this country before joining
+        load_glob_info = load_glob_info.loc[load_glob_info['iso3'].values == self.country_iso3]
+
         single_country = single_country.merge(load_glob_info, left_on = 'GID_0', 
             right_on = 'iso3')
         
@@ -401,40 +405,8 @@ class ProcessPopulation:
 
                     with rasterio.open(path_in) as src:
 
-                        affine = src.transform
-                        array = src.read(1)
-
-                        output = []
-
-                        for vec in rasterio.features.shapes(array):
-
-                            if vec[1] > 0 and not vec[1] == 255:
-
-                                coordinates = [i for i in vec[0]['coordinates'][0]]
-
-                                coords = []
-
-                                for i in coordinates:
-
-                                    x = i[0]
-                                    y = i[1]
-
-                                    x2, y2 = src.transform * (x, y)
-
-                                    coords.append((x2, y2))
-
-                                output.append({
-                                    'type': vec[0]['type'],
-                                    'geometry': {
-                                        'type': 'Polygon',
-                                        'coordinates': [coords],
-                                    },
-                                    'properties': {
-                                        'value': vec[1],
-                                    }
-                                })
+                        output = polygonise(src.read(1), src.transform, 'epsg:4326')
 
-                    output = gpd.GeoDataFrame.from_features(output, crs = 'epsg:4326')
                     output.to_file(path_out, driver = 'ESRI Shapefile')
 
             except:
@@ -556,40 +528,8 @@ class ProcessPopulation:
 
                     with rasterio.open(path_in) as src:
 
-                        affine = src.transform
-                        array = src.read(1)
-
-                        output = []
-
-                        for vec in rasterio.features.shapes(array):
-
-                            if vec[1] > 0 and not vec[1] == 255:
-
-                                coordinates = [i for i in vec[0]['coordinates'][0]]
-
-                                coords = []
-
-                                for i in coordinates:
-
-                                    x = i[0]
-                                    y = i[1]
-
-                                    x2, y2 = src.transform * (x, y)
-
-                                    coords.append((x2, y2))
-
-                                output.append({
-                                    'type': vec[0]['type'],
-                                    'geometry': {
-                                        'type': 'Polygon',
-                                        'coordinates': [coords],
-                                    },
-                                    'properties': {
-                                        'value': vec[1],
-                                    }
-                                })
+                        output = polygonise(src.read(1), src.transform, 'epsg:4326')
 
-                    output = gpd.GeoDataFrame.from_features(output, crs = 'epsg:4326')
                     output.to_file(path_out, driver = 'ESRI Shapefile')
 
             except:
@@ -1,16 +1,311 @@
+import functools
+import logging
+import logging.handlers
+import math
+import multiprocessing
 import os                 
-import json
 import rasterio
+import rasterio.shutil
+import shapely
+import time
 import warnings
-import contextily as cx
 import geopandas as gpd   
-import matplotlib.pyplot as plt
+import numpy as np
 import pandas as pd       
-import seaborn as sns
-from rasterio.mask import mask
-from shapely.geometry import MultiPolygon
+from concurrent.futures import ProcessPoolExecutor
+from rasterio.errors import RasterioIOError
+from rasterio.features import geometry_mask, shapes
+from rasterio import windows
+from rasterio.windows import Window, from_bounds
+from shapely import wkb
+from shapely.geometry import shape
 from tqdm import tqdm
 warnings.filterwarnings('ignore')
+logger = logging.getLogger(__name__)
+
+
+@functools.lru_cache(maxsize = 4)
+def load_countries(csv_filename):
+    """
+    Load the country metadata file once per run.
+
+    Parameters
+    ----------
+    csv_filename : string
+        Name of the country metadata file.
+
+    Returns
+    -------
+    countries : dataframe
+        Country metadata.
+
+    """
+    countries = pd.read_csv(csv_filename, encoding = 'utf-8-sig')
+
+    return countries
+
+
+def get_window(hazard, bounds):
+    """
+    Get the raster window covering a bounding box.
+
+    Parameters
+    ----------
+    hazard : rasterio dataset
+        Opened hazard raster layer.
+    bounds : tuple
+        Bounding box as (minx, miny, maxx, maxy).
+
+    Returns
+    -------
+    window : Window
+        Whole pixel window enclosing the bounding box.
+
+    """
+    window = from_bounds(*bounds, transform = hazard.transform)
+
+    col_off = math.floor(window.col_off)
+    row_off = math.floor(window.row_off)
+    width = math.ceil(window.col_off + window.width) - col_off
+    height = math.ceil(window.row_off + window.height) - row_off
+
+    return Window(col_off, row_off, max(width, 1), max(height, 1))
+
+
+def convert_to_cog(path_in, path_out):
+    """
+    Convert a hazard raster into a tiled Cloud-Optimized GeoTIFF.
+
+    Parameters
+    ----------
+    path_in : string
+        Path of the source hazard raster.
+    path_out : string
+        Path of the Cloud-Optimized GeoTIFF to write.
+
+    """
+    if os.path.exists(path_out):
+
+        return None
+
+    folder_out = os.path.dirname(path_out)
+
+    if not os.path.exists(folder_out):
+
+        os.makedirs(folder_out)
+
+    #write to a temporary path so an interrupted copy is never reused
+    path_tmp = '{}.tmp'.format(path_out)
+
+    rasterio.shutil.copy(path_in, path_tmp, driver = 'COG', 
+                         BLOCKSIZE = 512, OVERVIEWS = 'AUTO', 
+                         COMPRESS = 'DEFLATE')
+
+    os.replace(path_tmp, path_out)
+
+    return None
+
+
+def snap_window(window, block_shape):
+    """
+    Expand a window outwards to the internal 
+    block boundaries of the raster.
+
+    Parameters
+    ----------
+    window : Window
+        Whole pixel window.
+    block_shape : tuple
+        Block size as (rows, columns).
+
+    Returns
+    -------
+    window : Window
+        Block-aligned window enclosing the input window.
+
+    """
+    block_rows, block_cols = block_shape
+
+    col_off = (window.col_off // block_cols) * block_cols
+    row_off = (window.row_off // block_rows) * block_rows
+    width = math.ceil((window.col_off + window.width - col_off) / block_cols) * block_cols
+    height = math.ceil((window.row_off + window.height - row_off) / block_rows) * block_rows
+
+    return Window(col_off, row_off, width, height)
+
+
+def read_window(hazard, window):
+    """
+    Read a window of the hazard raster in its own 
+    dtype (float64 narrowed to float32 for shapes), 
+    filling nodata pixels and any beyond the raster 
+    edge with 255.
+
+    Parameters
+    ----------
+    hazard : rasterio dataset
+        Opened hazard raster layer.
+    window : Window
+        Whole pixel window to read.
+
+    Returns
+    -------
+    out_img : array
+        Hazard values within the window.
+
+    """
+    dtype = 'float32' if hazard.dtypes[0] == 'float64' else hazard.dtypes[0]
+    out_img = np.full((window.height, window.width), 255, dtype = dtype)
+    dataset_window = Window(0, 0, hazard.width, hazard.height)
+
+    if not windows.intersect(window, dataset_window):
+
+        return out_img
+
+    inside = window.intersection(dataset_window)
+    row_off = inside.row_off - window.row_off
+    col_off = inside.col_off - window.col_off
+
+    #mark the raster's own nodata pixels using its mask band
+    data = hazard.read(1, window = inside, out_dtype = dtype)
+    data[hazard.read_masks(1, window = inside) == 0] = 255
+
+    out_img[row_off:row_off + inside.height, col_off:col_off + inside.width] = data
+
+    return out_img
+
+
+def polygonise(array, transform, crs):
+    """
+    Convert the positive pixels of a raster array 
+    into polygons.
+
+    Parameters
+    ----------
+    array : array
+        Raster values, with 255 as nodata.
+    transform : Affine
+        Transform of the array.
+    crs : CRS
+        Coordinate reference system of the array.
+
+    Returns
+    -------
+    output : geodataframe
+        Polygons with their raster value.
+
+    """
+    valid = (array > 0) & (array != 255)
+
+    #shapes returns coordinates already in the raster crs
+    geoms = []
+    values = []
+
+    for geom, value in shapes(array, mask = valid, transform = transform):
+
+        geoms.append(shape(geom))
+        values.append(value)
+
+    output = gpd.GeoDataFrame({'value': np.array(values, dtype = array.dtype)}, 
+                              geometry = geoms, crs = crs)
+
+    return output
+
+
+def init_worker_logging(log_queue, level):
+    """
+    Send the log records of a worker process to the 
+    parent process, which owns the configured handlers.
+
+    Parameters
+    ----------
+    log_queue : Queue
+        Queue read by the parent's QueueListener.
+    level : int
+        Logging level of the parent's root logger.
+
+    """
+    root = logging.getLogger()
+    root.handlers = [logging.handlers.QueueHandler(log_queue)]
+    root.setLevel(level)
+
+    return None
+
+
+def clip_regions(task):
+    """
+    Clip the hazard raster to the regions sharing a 
+    read window and write each out as a tif, or 
+    straight to polygons when a vector folder is given.
+
+    Parameters
+    ----------
+    task : tuple
+        Country iso3, shared read window, list of 
+        region gid id, region geometry as WKB and region 
+        window, hazard raster path, tif output folder 
+        and vector output folder (or None).
+
+    """
+    iso3, block_window, regions, path_hazard, folder_out, folder_vectors = task
+
+    with rasterio.Env(GDAL_CACHEMAX = 512, 
+                      GDAL_DISABLE_READDIR_ON_OPEN = 'EMPTY_DIR'):
+
+        #opened once per group of regions and closed with the task
+        with rasterio.open(path_hazard) as hazard:
+
+            #a single read covers every region in the group
+            block_img = read_window(hazard, block_window)
+            out_meta = hazard.meta.copy()
+
+            for gid_id, geom_wkb, window in regions:
+
+                start = time.perf_counter_ns()
+                geometry = wkb.loads(geom_wkb)
+
+                row_off = window.row_off - block_window.row_off
+                col_off = window.col_off - block_window.col_off
+                out_img = block_img[row_off:row_off + window.height, 
+                                    col_off:col_off + window.width].copy()
+                out_transform = hazard.window_transform(window)
+
+                #blank out the pixels falling outside the region
+                region_mask = geometry_mask([geometry.__geo_interface__], 
+                                            out_shape = out_img.shape, 
+                                            transform = out_transform, 
+                                            invert = False)
+                out_img[region_mask] = 255
+
+                out_meta.update({'driver': 'GTiff', 'height': out_img.shape[0],
+                                'width': out_img.shape[1], 'count': 1, 
+                                'dtype': out_img.dtype.name, 'transform': out_transform, 
+                                'nodata': 255,
+                                'crs': hazard.crs or 'epsg:4326'})
+
+                if folder_vectors is not None:
+
+                    #polygonise in memory, skipping the intermediate tif
+                    output = polygonise(out_img, out_transform, out_meta['crs'])
+                    output.to_parquet(os.path.join(folder_vectors, '{}.parquet'.format(gid_id)))
+
+                    logger.info('stage=clip_shapes iso3=%s gid=%s dur_ns=%d', iso3, 
+                                gid_id, time.perf_counter_ns() - start)
+
+                    continue
+
+                filename_out = '{}.tif'.format(gid_id) 
+                path_out = os.path.join(folder_out, filename_out)
+
+                with rasterio.open(path_out, 'w', ** out_meta) as dest:
+
+                    dest.write(out_img, 1)
+
+                logger.info('stage=clip iso3=%s gid=%s dur_ns=%d', iso3, 
+                            gid_id, time.perf_counter_ns() - start)
+
+    return None
+
 
 class FloodProcess:
     """
@@ -34,83 +329,147 @@ class FloodProcess:
         self.country_iso3 = country_iso3
         self.flood_tiff = flood_tiff
 
-    def process_flood_tiff(self):
+    def process_flood_tiff(self, polygonise_regions = False):
         """
         Pre-process flood layers.
 
+        Arguments
+        ---------
+        polygonise_regions : bool
+            If True, each clipped region is polygonised in 
+            memory and written as GeoParquet instead of 
+            being written as a tif for process_flood_shapefile.
+
         """
-        countries = pd.read_csv(self.csv_filename, encoding = 'utf-8-sig')
-        
-        for idx, country in countries.iterrows():
+        countries = load_countries(self.csv_filename)
+        country = countries.loc[countries['iso3'].values == self.country_iso3]
 
-            if not country['iso3'] == self.country_iso3: 
+        if country.empty:
 
-                continue   
+            return None
+
+        country = country.iloc[0]
+
+        iso3 = country['iso3']
+        gid_region = country['gid_region']
+        gid_level = 'GID_{}'.format(gid_region)
+        large_countries = ['ARG', 'BRA', 'CHN', 'USA', 'DZA', 'IND', 'RUS']
+        if country['iso3'] in large_countries:
             
-            iso3 = country['iso3']
-            gid_region = country['gid_region']
+            filename = 'regions_1_{}.shp'.format(iso3)
+            gid_level = 'GID_1'
+
+        else:
+
+            filename = 'regions_{}_{}.shp'.format(gid_region, iso3)
             gid_level = 'GID_{}'.format(gid_region)
-            large_countries = ['ARG', 'BRA', 'CHN', 'USA', 'DZA', 'IND', 'RUS']
-            if country['iso3'] in large_countries:
-                
-                filename = 'regions_1_{}.shp'.format(iso3)
-                gid_level = 'GID_1'
 
-            else:
+        folder = os.path.join('results','processed', iso3, 'regions')
+        
+        path_regions = os.path.join(folder, filename)
+        regions = gpd.read_file(path_regions, crs = 'epsg:4326')
 
-                filename = 'regions_{}_{}.shp'.format(gid_region, iso3)
-                gid_level = 'GID_{}'.format(gid_region)
+        folder_out = os.path.join('results', 'processed', self.country_iso3, 'hazards', 'inunriver', 'tifs')
+        folder_vectors = None
 
-            folder = os.path.join('results','processed', iso3, 'regions')
-            
-            path_regions = os.path.join(folder, filename)
-            regions = gpd.read_file(path_regions, crs = 'epsg:4326')
-            
-            for idx, region in regions.iterrows():
+        if polygonise_regions:
 
-                gid_id = region[gid_level]
-                filename = self.flood_tiff
-                path_hazard = os.path.join(filename)
-                hazard = rasterio.open(path_hazard, 'r+')
-                hazard.nodata = 255                       
-                hazard.crs.from_epsg(4326)                
+            folder_vectors = os.path.join('results', 'processed', self.country_iso3, 'hazards', 'inunriver', 'shapefiles')
 
-                geo = gpd.GeoDataFrame(gpd.GeoSeries(region.geometry))
+        folder = folder_vectors or folder_out
 
-                geo = geo.rename(columns = {0:'geometry'}).set_geometry('geometry')
+        if not os.path.exists(folder):
 
-                coords = [json.loads(geo.to_json())['features'][0]['geometry']] 
-                
-                out_img, out_transform = mask(hazard, coords, crop = True)
+            os.makedirs(folder)
 
-                out_meta = hazard.meta.copy()
+        filename = self.flood_tiff
+        path_hazard = os.path.join(filename)
 
-                out_meta.update({'driver': 'GTiff', 'height': out_img.shape[1],
-                                'width': out_img.shape[2], 'transform': out_transform,
-                                'crs': 'epsg:4326'})
-                
-                filename_out = '{}.tif'.format(gid_id) 
-                folder_out = os.path.join('results', 'processed', self.country_iso3, 'hazards', 'inunriver', 'tifs')
+        with rasterio.open(path_hazard) as hazard:
 
-                if not os.path.exists(folder_out):
+            #reproject all regions to the hazard crs in a single call
+            if hazard.crs is not None and regions.crs is not None:
 
-                    os.makedirs(folder_out)
+                regions = regions.to_crs(hazard.crs)
 
-                path_out = os.path.join(folder_out, filename_out)
+            gids = regions[gid_level].to_numpy()
+            geoms = shapely.to_wkb(regions.geometry.values)
+            bounds = regions.geometry.bounds.to_numpy()
 
-                with rasterio.open(path_out, 'w', ** out_meta) as dest:
+            #group regions starting in the same internal block, only on tiled 
+            #rasters as a strip spans the whole raster width
+            dataset_window = Window(0, 0, hazard.width, hazard.height)
+            block_shape = hazard.block_shapes[0]
+            tiled = block_shape[1] < hazard.width
+            groups = {}
 
-                    dest.write(out_img)
-            
-            print('Processing complete for {}'.format(iso3))
+            for idx, (gid_id, geom_wkb, region_bounds) in enumerate(zip(gids, geoms, bounds)):
+
+                window = get_window(hazard, region_bounds)
+
+                if not windows.intersect(window, dataset_window):
+
+                    logger.warning('Region %s does not overlap %s', gid_id, path_hazard)
+
+                    continue
+
+                window = window.intersection(dataset_window)
+
+                if tiled:
+
+                    key = (window.row_off // block_shape[0], window.col_off // block_shape[1])
+
+                else:
+
+                    key = (idx, )
+
+                groups.setdefault(key, []).append((gid_id, geom_wkb, window))
+
+        tasks = []
+
+        for key in sorted(groups):
+
+            #one read covering every region of the group
+            block_window = windows.union(*[window for _, _, window in groups[key]])
+
+            if tiled:
+
+                block_window = snap_window(block_window, block_shape).intersection(dataset_window)
+
+            tasks.append((iso3, block_window, groups[key], 
+                          path_hazard, folder_out, folder_vectors))
+
+        #each group of regions is clipped and written independently
+        max_workers = max(1, int(0.7 * os.cpu_count()))
+
+        #forward worker log records to the handlers configured in this process
+        log_queue = multiprocessing.Queue()
+        listener = logging.handlers.QueueListener(log_queue, *logging.getLogger().handlers, 
+                                                  respect_handler_level = True)
+        listener.start()
+
+        try:
+
+            with ProcessPoolExecutor(max_workers = max_workers, 
+                                     initializer = init_worker_logging, 
+                                     initargs = (log_queue, logging.getLogger().level)) as executor:
+
+                list(executor.map(clip_regions, tasks))
+
+        finally:
+
+            listener.stop()
         
+        print('Processing complete for {}'.format(iso3))
+    
         return None 
 
 
     def process_flood_shapefile(self):
 
         """
-        This function process each of the tif files into shapefiles
+        This function process each of the tif files into 
+        GeoParquet vector layers
         """
         folder = os.path.join('results', 'processed', self.country_iso3, 'hazards', 'inunriver', 'tifs')
 
@@ -132,48 +491,23 @@ class FloodProcess:
                         
                         os.mkdir(folder)
                         
-                    filename = tifs + '.shp'
+                    filename = tifs + '.parquet'
                     path_out = os.path.join(folder, filename)
 
-                    with rasterio.open(path_in) as src:
+                    start = time.perf_counter_ns()
 
-                        affine = src.transform
-                        array = src.read(1)
-
-                        output = []
-
-                        for vec in rasterio.features.shapes(array):
-
-                            if vec[1] > 0 and not vec[1] == 255:
-
-                                coordinates = [i for i in vec[0]['coordinates'][0]]
-
-                                coords = []
-
-                                for i in coordinates:
+                    with rasterio.open(path_in) as src:
 
-                                    x = i[0]
-                                    y = i[1]
+                        output = polygonise(src.read(1), src.transform, 
+                                            src.crs or 'epsg:4326')
 
-                                    x2, y2 = src.transform * (x, y)
+                    output.to_parquet(path_out)
 
-                                    coords.append((x2, y2))
+                    logger.info('stage=shapes iso3=%s gid=%s dur_ns=%d', self.country_iso3, 
+                                tifs, time.perf_counter_ns() - start)
 
-                                output.append({
-                                    'type': vec[0]['type'],
-                                    'geometry': {
-                                        'type': 'Polygon',
-                                        'coordinates': [coords],
-                                    },
-                                    'properties': {
-                                        'value': vec[1],
-                                    }
-                                })
+            except (RasterioIOError, ValueError) as e:
 
-                    output = gpd.GeoDataFrame.from_features(output, crs = 'epsg:4326')
-                    output.to_file(path_out, driver = 'ESRI Shapefile')
-            except:
-            
-                pass
+                logger.warning('Unable to process %s flood shapefile: %s', tifs, e)
             
         return None
\ No newline at end of file